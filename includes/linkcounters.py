@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+
+import numpy as np
+import os
+
+# per link byte/packet counters written by the patched simulator when enable-trace has bit 4 set
+# layout: header with the bin width, then one record per (node, interface, bin) that saw traffic
+# sorted by node, interface then bin, all values little endian
+MAGIC = b'ASTRACNT'
+VERSION = 1
+
+HEADER = np.dtype ([
+  ('magic', 'S8'),
+  ('version', '<u4'),
+  ('record', '<u4'),
+  ('width', '<f8')
+])
+
+RECORD = np.dtype ([
+  ('node', '<u4'),
+  ('link', '<u2'),
+  ('reserved', '<u2'),
+  ('bin', '<u4'),
+  ('padding', '<u4'),
+  ('bytes', '<u8'),
+  ('packets', '<u8')
+])
+
+def is_counters (filename):
+  with open (filename, 'rb') as file:
+    return file.read (len (MAGIC)) == MAGIC
+
+def open_counters (filename):
+  # bin width (s) and memory mapped records
+  header = np.fromfile (filename, dtype = HEADER, count = 1)[0]
+  if header['magic'] != MAGIC or header['version'] != VERSION or header['record'] != RECORD.itemsize:
+    raise ValueError ('%s is not a version %d link counter table' % (filename, VERSION))
+  count = (os.path.getsize (filename) - HEADER.itemsize) // RECORD.itemsize
+  if count == 0:
+    return float (header['width']), np.zeros (0, dtype = RECORD)
+  return float (header['width']), np.memmap (filename, dtype = RECORD, mode = 'r', offset = HEADER.itemsize, shape = (count,))
+
+def counter_columns (records):
+  # node,link,bin,bytes,packets with links 0 indexed like the parsed packet files
+  return {
+    'node': np.asarray (records['node'], dtype = np.int64),
+    'link': np.asarray (records['link'], dtype = np.int64) - 1,
+    'bin': np.asarray (records['bin'], dtype = np.int64),
+    'bytes': np.asarray (records['bytes'], dtype = np.float64),
+    'packets': np.asarray (records['packets'], dtype = np.float64)
+  }
@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+
+import numpy as np
+
+# links of an ns3 topology file numbered in file order, shared by the packet parser and the power model
+# interfaces of a node are numbered in the order its links appear in the file like the simulator does
+# (node, interface) resolves to link interface[offset[node] + interface]
+
+def read_pairs (topology_filename):
+  # (node-a, node-b) of every link with node-a <= node-b and the switch ids
+  with open (topology_filename, 'r') as topology:
+    lines = topology.read ().splitlines ()
+  nlinks = int (lines[0].split ()[2])
+  switches = set ([int (n) for n in lines[1].split ()])
+  pairs = []
+  for line in lines[2:2 + nlinks]:
+    a, b = [int (n) for n in line.split ()[:2]]
+    pairs.append ((min (a, b), max (a, b)))
+  return pairs, switches
+
+def node_levels (pairs, switches = set ()):
+  # hops of every node from the nearest compute node (any linked node that is not a switch)
+  # compute nodes are 0, unlinked nodes -1
+  nnodes = max ([b for _, b in pairs], default = -1) + 1
+  level = np.full (nnodes, -1, dtype = np.int64)
+  neighbours = [[] for _ in range (nnodes)]
+  for a, b in pairs:
+    neighbours[a].append (b)
+    neighbours[b].append (a)
+  # breadth first from every compute node at once
+  frontier = [n for n in range (nnodes) if n not in switches and len (neighbours[n]) > 0]
+  level[frontier] = 0
+  while len (frontier) > 0:
+    following = []
+    for n in frontier:
+      for m in neighbours[n]:
+        if level[m] < 0:
+          level[m] = level[n] + 1
+          following.append (m)
+    frontier = following
+  return level
+
+def link_table (pairs, switches = set ()):
+  nnodes = max ([b for _, b in pairs], default = -1) + 1
+  # endpoints in file order, a stable sort by node keeps the interface order of every node
+  endpoints = np.array (pairs, dtype = np.int64).reshape (-1)
+  counts = np.bincount (endpoints, minlength = nnodes)
+  table = {
+    'node-a': endpoints[0::2],
+    'node-b': endpoints[1::2],
+    'offset': np.concatenate (([0], np.cumsum (counts))),
+    'interface': np.repeat (np.arange (len (pairs), dtype = np.int64), 2)[np.argsort (endpoints, kind = 'stable')],
+    'switch': np.isin (np.arange (nnodes), list (switches))
+  }
+  # tier of a link is its hop distance from the compute nodes, compute to switch links are tier 1
+  level = node_levels (pairs, switches)
+  table['tier'] = np.minimum (level[table['node-a']], level[table['node-b']]) + 1
+  return table
+
+def read_link_table (topology_filename):
+  return link_table (*read_pairs (topology_filename))
+
+def resolve_links (table, node, link):
+  # link numbers of whole (node, interface) columns at once
+  return table['interface'][table['offset'][np.asarray (node, dtype = np.int64)] + np.asarray (link, dtype = np.int64)]
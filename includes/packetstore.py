@@ -0,0 +1,312 @@
+#!/usr/bin/python3
+
+import numpy as np
+import os
+
+# binary packet store written by ns3.py and read by power.py/remove-unused-link.py/flows.py
+# layout: header, typed columns with room for capacity records, then the segment log
+#   a segment is a run of records sorted by receive time, a store written in one go has one
+#   and every append of --follow adds one past the committed records
+#   the log holds one SEGMENT record per segment followed by its keys and counts
+#   keys list every (node << 16 | link) interface that received packets, counts its records
+# the header is written last, count and tail only ever cover complete segments
+# every section starts on an 8 byte boundary, all values little endian
+# sample N means 1 in N received packets were recorded
+# flag LINKS adds the link id (topology order) and tier of every record resolved by ns3.py
+# max-size is the largest record size, bounds the transfer time of any packet without a scan
+MAGIC = b'ASTRAPKT'
+VERSION = 3
+LINKS = 1
+
+HEADER = np.dtype ([
+  ('magic', 'S8'),
+  ('version', '<u4'),
+  ('sample', '<u4'),
+  ('flags', '<u4'),
+  ('max-size', '<u4'),
+  ('count', '<u8'),
+  ('capacity', '<u8'),
+  ('nsegments', '<u8'),
+  ('tail', '<u8')
+])
+
+SEGMENT = np.dtype ([
+  ('first', '<u8'),
+  ('count', '<u8'),
+  ('nkeys', '<u8'),
+  ('max-size', '<u8'),
+  ('min-time', '<f8'),
+  ('max-time', '<f8')
+])
+
+COLUMNS = [
+  ('timestamp', '<f8'),
+  ('node', '<u4'),
+  ('src', '<u4'),
+  ('dst', '<u4'),
+  ('size', '<u4'),
+  ('link', '<u2')
+]
+
+LINK_COLUMNS = [
+  ('link-id', '<u4'),
+  ('tier', '<u1')
+]
+
+def store_columns (links):
+  return COLUMNS + (LINK_COLUMNS if links else [])
+
+def layout (offset, sections, lengths):
+  # (name, dtype, length, offset) of every section starting at offset
+  out = []
+  for (name, dtype), length in zip (sections, lengths):
+    out.append ((name, np.dtype (dtype), length, offset))
+    offset = offset + np.dtype (dtype).itemsize * length
+    offset = (offset + 7) // 8 * 8
+  return out
+
+def store_layout (header):
+  columns = store_columns (header['flags'] & LINKS)
+  return layout (HEADER.itemsize, columns + [('log', '<u1')], [int (header['capacity'])] * len (columns) + [int (header['tail'])])
+
+def is_store (filename):
+  with open (filename, 'rb') as file:
+    return file.read (len (MAGIC)) == MAGIC
+
+def read_header (filename):
+  header = np.fromfile (filename, dtype = HEADER, count = 1)
+  if len (header) == 0 or header[0]['magic'] != MAGIC or header[0]['version'] != VERSION:
+    raise ValueError ('%s is not a version %d packet store' % (filename, VERSION))
+  return header[0]
+
+def store_sample (filename):
+  return max (1, int (read_header (filename)['sample']))
+
+def store_max_size (filename):
+  return int (read_header (filename)['max-size'])
+
+def interface_keys (node, link):
+  return np.asarray (node).astype (np.uint64) << np.uint64 (16) | np.asarray (link).astype (np.uint64)
+
+def sum_keys (keys, counts):
+  # per interface totals of lists of (keys, counts)
+  unique, inverse = np.unique (np.concatenate ([np.zeros (0, dtype = np.uint64)] + list (keys)), return_inverse = True)
+  weights = np.concatenate ([np.zeros (0, dtype = np.uint64)] + list (counts)).astype (np.float64)
+  return unique, np.bincount (inverse.reshape (-1), weights = weights, minlength = len (unique)).astype (np.uint64)
+
+def count_keys (keys, counts, node, link):
+  # running record count per interface
+  return sum_keys ([keys, interface_keys (node, link)], [counts, np.ones (len (node), dtype = np.uint64)])
+
+def read_log (log, nsegments):
+  # SEGMENT records and the keys and counts following each of them
+  segments, keys, counts = [], [], []
+  offset = 0
+  for _ in range (nsegments):
+    segment = np.frombuffer (log, dtype = SEGMENT, count = 1, offset = offset)[0]
+    nkeys = int (segment['nkeys'])
+    offset = offset + SEGMENT.itemsize
+    keys.append (np.frombuffer (log, dtype = '<u8', count = nkeys, offset = offset))
+    counts.append (np.frombuffer (log, dtype = '<u8', count = nkeys, offset = offset + 8 * nkeys))
+    offset = offset + 16 * nkeys
+    segments.append (segment)
+  return np.array (segments, dtype = SEGMENT), keys, counts
+
+def merge_runs (runs, block = 1 << 20):
+  # k-way merge of time sorted runs (dicts of equal length columns, memory mapped or not)
+  # into time sorted chunks, at most block records of every run are in memory at once
+  # ties keep run order then record order, like a stable sort of the runs one after the other
+  position = [0] * len (runs)
+  length = [len (run['timestamp']) for run in runs]
+  while True:
+    live = [i for i in range (len (runs)) if position[i] < length[i]]
+    if len (live) == 0:
+      return
+    # nothing at or past the earliest block end can be emitted before the next blocks are seen
+    bound = min ([runs[i]['timestamp'][min (position[i] + block, length[i]) - 1] for i in live])
+    stop = {i: position[i] + int (np.searchsorted (runs[i]['timestamp'][position[i]:min (position[i] + block, length[i])], bound, side = 'left')) for i in live}
+    if all ([stop[i] == position[i] for i in live]):
+      # every run is at bound, all records equal to it go out together
+      stop = {i: position[i] + int (np.searchsorted (runs[i]['timestamp'][position[i]:], bound, side = 'right')) for i in live}
+    pieces = [{key: np.asarray (runs[i][key][position[i]:stop[i]]) for key in runs[i]} for i in live if stop[i] > position[i]]
+    for i in live:
+      position[i] = stop[i]
+    chunk = {key: np.concatenate ([piece[key] for piece in pieces]) for key in pieces[0]}
+    order = np.argsort (chunk['timestamp'], kind = 'stable')
+    yield {key: column[order] for key, column in chunk.items ()}
+
+def commit_segment (filename, header, keys, counts, count, times, largest):
+  # the segment record goes past the log tail and reaches disk before the header that covers it
+  segment = np.zeros (1, dtype = SEGMENT)
+  segment['first'] = header['count']
+  segment['count'] = count
+  segment['nkeys'] = len (keys)
+  segment['max-size'] = largest
+  segment['min-time'], segment['max-time'] = times
+  record = segment.tobytes () + keys.astype ('<u8').tobytes () + counts.astype ('<u8').tobytes ()
+  with open (filename, 'r+b') as file:
+    file.seek (store_layout (header[0])[-1][3] + int (header['tail'][0]))
+    file.write (record)
+    file.flush ()
+    os.fsync (file.fileno ())
+    header['count'] = int (header['count'][0]) + count
+    header['nsegments'] = int (header['nsegments'][0]) + 1
+    header['tail'] = int (header['tail'][0]) + len (record)
+    header['max-size'] = max (int (header['max-size'][0]), largest)
+    file.seek (0)
+    file.write (header.tobytes ())
+
+def write_blocks (filename, blocks, count, sample = 1, links = False, capacity = None):
+  # count records arriving in time order as column blocks, written straight into the mapped file
+  # as a single segment, capacity leaves room for appending more
+  header = np.zeros (1, dtype = HEADER)
+  header['magic'] = MAGIC
+  header['version'] = VERSION
+  header['sample'] = sample
+  header['flags'] = LINKS if links else 0
+  header['capacity'] = count if capacity is None else max (capacity, count)
+  sections = store_layout (header[0])
+  with open (filename, 'wb') as file:
+    file.write (header.tobytes ())
+    file.truncate (sections[-1][3])
+  mapped = {}
+  for name, dtype, length, offset in sections[:-1]:
+    mapped[name] = np.memmap (filename, dtype = dtype, mode = 'r+', offset = offset, shape = (count,)) if count > 0 else None
+  written = 0
+  largest = 0
+  times = [0.0, 0.0]
+  keys = np.zeros (0, dtype = np.uint64)
+  counts = np.zeros (0, dtype = np.uint64)
+  for block in blocks:
+    n = len (block['timestamp'])
+    if written + n > count:
+      raise ValueError ('%s expected (%d) records' % (filename, count))
+    if n == 0:
+      continue
+    for name in mapped:
+      mapped[name][written:written + n] = np.asarray (block[name]).astype (mapped[name].dtype)
+    keys, counts = count_keys (keys, counts, block['node'], block['link'])
+    largest = max (largest, int (np.max (block['size'])))
+    times = [times[0] if written > 0 else float (block['timestamp'][0]), float (block['timestamp'][-1])]
+    written = written + n
+  if written != count:
+    raise ValueError ('%s expected (%d) records, got (%d)' % (filename, count, written))
+  for column in mapped.values ():
+    if column is not None:
+      column.flush ()
+  del mapped
+  if count > 0:
+    commit_segment (filename, header, keys, counts, count, times, largest)
+
+def write_store (filename, columns, sample = 1):
+  # columns hold timestamp,node,link,src,dst,size as arrays of equal length
+  # and link-id,tier when the links were resolved
+  order = np.argsort (columns['timestamp'], kind = 'stable')
+  data = {name: np.asarray (column)[order] for name, column in columns.items ()}
+  write_blocks (filename, [data], len (order), sample, 'link-id' in columns)
+
+def open_store (filename):
+  # memory mapped columns of the committed records, their segments and per interface counts
+  # nothing is read from the columns until it is touched
+  header = read_header (filename)
+  count = int (header['count'])
+  columns = [name for name, _ in store_columns (True)]
+  store = {}
+  for name, dtype, length, offset in store_layout (header):
+    if name in columns:
+      length = count
+    if length == 0:
+      store[name] = np.zeros (0, dtype = dtype)
+    else:
+      store[name] = np.memmap (filename, dtype = dtype, mode = 'r', offset = offset, shape = (length,))
+  store['segments'], keys, counts = read_log (store.pop ('log'), int (header['nsegments']))
+  store['keys'], store['counts'] = sum_keys (keys, counts)
+  return store
+
+def time_range (store, lo = None, hi = None):
+  # record range [first, last) with lo < timestamp <= hi, binary search on the sorted column
+  timestamp = store['timestamp']
+  first = 0 if lo is None else int (np.searchsorted (timestamp, lo, side = 'right'))
+  last = len (timestamp) if hi is None else int (np.searchsorted (timestamp, hi, side = 'right'))
+  return first, max (first, last)
+
+def store_chunks (store, names, lo = None, hi = None, chunk_size = None):
+  # chunks of the named columns (timestamp among them) in time order with lo < timestamp <= hi
+  # segments outside the window are not touched, a single segment is sliced in place
+  # and more are merged with ties in segment order
+  runs = []
+  for segment in store['segments']:
+    if (lo is not None and segment['max-time'] <= lo) or (hi is not None and segment['min-time'] > hi):
+      continue
+    first = int (segment['first'])
+    run = {name: store[name][first:first + int (segment['count'])] for name in names}
+    begin, end = time_range (run, lo, hi)
+    if end > begin:
+      runs.append ({name: column[begin:end] for name, column in run.items ()})
+  if len (runs) == 1:
+    count = len (runs[0]['timestamp'])
+    step = count if chunk_size is None else max (chunk_size, 1)
+    for begin in range (0, count, step):
+      yield {name: np.asarray (column[begin:begin + step]) for name, column in runs[0].items ()}
+  elif len (runs) > 1 and chunk_size is None:
+    chunk = {name: np.concatenate ([np.asarray (run[name]) for run in runs]) for name in names}
+    order = np.argsort (chunk['timestamp'], kind = 'stable')
+    yield {name: column[order] for name, column in chunk.items ()}
+  elif len (runs) > 1:
+    for chunk in merge_runs (runs, max (1, chunk_size // len (runs))):
+      yield chunk
+
+def compact_store (filename, capacity, block = 1 << 20):
+  # every segment merged into one, rewritten with room for capacity records
+  store = open_store (filename)
+  links = 'link-id' in store
+  names = [name for name, _ in store_columns (links)]
+  runs = [{name: store[name][int (s['first']):int (s['first'] + s['count'])] for name in names} for s in store['segments']]
+  scratch = filename + '.tmp'
+  write_blocks (scratch, merge_runs (runs, max (1, block // max (1, len (runs)))), len (store['timestamp']), store_sample (filename), links, capacity)
+  del store, runs
+  os.replace (scratch, filename)
+
+def append_store (filename, columns):
+  # new records go past the committed ones as one more segment and only the log and header
+  # are written, the store grows by doubling and is compacted then
+  # returns the committed record count, a crash before the header is written leaves the previous store
+  if not os.path.exists (filename):
+    write_blocks (filename, [], 0, 1, 'link-id' in columns)
+  header = np.fromfile (filename, dtype = HEADER, count = 1)
+  n = len (columns['timestamp'])
+  count = int (read_header (filename)['count'])
+  if n == 0:
+    return count
+  if count + n > int (header['capacity'][0]):
+    compact_store (filename, 2 * (count + n))
+    header = np.fromfile (filename, dtype = HEADER, count = 1)
+  order = np.argsort (columns['timestamp'], kind = 'stable')
+  data = {name: np.asarray (column)[order] for name, column in columns.items ()}
+  for name, dtype, length, offset in store_layout (header[0])[:-1]:
+    column = np.memmap (filename, dtype = dtype, mode = 'r+', offset = offset + dtype.itemsize * count, shape = (n,))
+    column[:] = data[name].astype (dtype)
+    column.flush ()
+    del column
+  keys, counts = count_keys (np.zeros (0, dtype = np.uint64), np.zeros (0, dtype = np.uint64), data['node'], data['link'])
+  commit_segment (filename, header, keys, counts, n, (float (data['timestamp'][0]), float (data['timestamp'][-1])), int (np.max (data['size'])))
+  return count + n
+
+def truncate_store (filename, count):
+  # drop the segments past the first count records, --follow rolls back to its checkpoint
+  header = read_header (filename)
+  if int (header['count']) == count:
+    return
+  segments = open_store (filename)['segments']
+  ends = np.concatenate (([0], np.cumsum (segments['count'])))
+  if count not in ends:
+    raise ValueError ('%s has no segment ending at (%d) records' % (filename, count))
+  keep = int (np.flatnonzero (ends == count)[0])
+  header = np.fromfile (filename, dtype = HEADER, count = 1)
+  header['count'] = count
+  header['nsegments'] = keep
+  header['tail'] = int (np.sum (SEGMENT.itemsize + 16 * segments['nkeys'][:keep]))
+  header['max-size'] = int (np.max (segments['max-size'][:keep])) if keep > 0 else 0
+  with open (filename, 'r+b') as file:
+    file.write (header.tobytes ())
+    file.truncate (store_layout (header[0])[-1][3] + int (header['tail'][0]))
@@ -139,6 +139,8 @@ class GenericLink (Node):
     # set specs
     this._bw = 1e9
     this._latency = 500e-9
+    # energy per transferred bit (J), 0 leaves the per bit model unused
+    this._epb = 0.0
 
   def bw (this, nbw = None):
     if nbw is not None:
@@ -150,6 +152,11 @@ class GenericLink (Node):
       this._latency = nlatency
     return this._latency
 
+  def epb (this, nepb = None):
+    if nepb is not None:
+      this._epb = nepb
+    return this._epb
+
   def anode (this):
     if len (this._ports) > 0:
       return this._ports[0]
@@ -171,6 +178,7 @@ class NVLink (GenericLink):
     # this.latency (50e-9) # switch latency
     this.idle (0.0)
     this.peak (5.5 * 2) # change this
+    this.epb (1.3e-12) # 1.3pJ per bit
 
 class Infiniband (GenericLink):
   def __init__ (this, src, dst = None):
@@ -264,11 +272,16 @@ class NVLinkSwitch (GenericSwitch):
       NVLink,
       NVLink
     ])
+    this.idle (40.0)
+    this.peak (100.0) # change this
 
 class InfinibandSwitch (GenericSwitch):
   def __init__ (this, nports):
     types = [Infiniband for _ in range (nports)]
     super ().__init__ (nports, types)
+    # using QM8790 max power with passive cables
+    this.idle (125.0)
+    this.peak (253.0)
 
 class GenericCompute (GenericEndpoint):
   def __init__ (this, nports = 1, types = None):
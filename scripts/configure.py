@@ -12,6 +12,7 @@ import yaml
 
 import etgenerate
 from astragen import encode, GlobalMetadata
+from linktable import node_levels, read_pairs
 try:
   from yaml import CLoader as Loader, CDumper as Dumper
 except ImportError:
@@ -32,6 +33,22 @@ class Mappings ():
     'npus': 'logical-dims'
   }
 
+def select_trace_nodes (trace, topology, ncount):
+  # node ids picked by the design trace section from the ns3 topology file
+  #   nodes: all (default), compute or a list of ids
+  #   tiers: list of tiers, hops from the nearest compute node (compute is 0), overrides nodes
+  with open (topology, 'r') as topfile:
+    nnodes = int (topfile.readline ().split ()[0])
+  if 'tiers' in trace:
+    level = node_levels (*read_pairs (topology))
+    return [i for i in range (len (level)) if int (level[i]) in trace['tiers']]
+  nodes = trace.get ('nodes', 'all')
+  if nodes == 'all':
+    return list (range (nnodes))
+  if nodes == 'compute':
+    return list (range (ncount))
+  return sorted (set ([int (i) for i in nodes if 0 <= int (i) < nnodes]))
+
 def generate_config_ns3 (filename, design, target_design, target_workload, binary, overwrite = True):
   # network
   network = {
@@ -119,7 +136,7 @@ def generate_config_ns3 (filename, design, target_design, target_workload, binar
       'rate-bound': 1,
       'ack-high_prio': 0,
       'link-down': [0, 0, 0],
-      'enable-trace': 1,
+      'enable-trace': 1, # mask, 1 ascii traces per device, 2 binary receive trace, 4 link counters
       'kmax-map': [6, 25000000000, 400, 40000000000, 800, 100000000000, 1600, 200000000000, 2400, 800000000000, 3200, 1600000000000, 3200],
       'kmin-map': [6, 25000000000, 100, 40000000000, 200, 100000000000, 400, 200000000000, 600, 800000000000, 800, 1600000000000, 800],
       'pmax-map': [6, 25000000000, 0.2, 40000000000, 0.2, 100000000000, 0.2, 200000000000, 0.2, 800000000000, 0.2, 1600000000000, 0.2],
@@ -162,6 +179,14 @@ def generate_config_ns3 (filename, design, target_design, target_workload, binar
   for arg in ns3['opt'].keys ():
     if arg in design['ns3']:
       ns3['opt'][arg] = design['ns3'][arg]
+  # traced nodes, 1 in N packet sampling of the binary receive trace and link counter bins (ns)
+  trace = design['ns3'].get ('trace', {})
+  # only the binary receive trace is sampled, asking for sampling turns it on
+  # and replaces the full ascii traces unless enable-trace was given
+  if trace.get ('sample', 1) > 1 and not ns3['opt']['enable-trace'] & 2:
+    mask = ns3['opt']['enable-trace'] | 2 if 'enable-trace' in design['ns3'] else 2
+    print ('trace sample (%d) applies to the binary receive trace, enable-trace (%d) -> (%d)' % (trace['sample'], ns3['opt']['enable-trace'], mask))
+    ns3['opt']['enable-trace'] = mask
       # nodes switches links
       # switch names
 
@@ -234,15 +259,16 @@ def generate_config_ns3 (filename, design, target_design, target_workload, binar
       ns3['opt']['trace-file'] = os.path.join (inputs, os.path.basename (ns3['opt']['trace-file']))
     else:
       # create trace file
-      nswitches = None
-      with open (ns3['req']['topology-file'], 'r') as topfile:
-        data = topfile.read().splitlines ()
-        nswitches = int (data[0].split (' ')[1])
-      nnodes = ncount + nswitches
+      nodes = select_trace_nodes (trace, ns3['req']['topology-file'], ncount)
       ns3['opt']['trace-file'] = os.path.join (inputs, 'ns3_trace.txt')
       with open (ns3['opt']['trace-file'], 'w') as tracefile:
-        tracefile.write ('%d\n' % (nnodes))
-        tracefile.write (' '.join ([str(i) for i in range (nnodes)]))
+        tracefile.write ('%d\n' % (len (nodes)))
+        tracefile.write (' '.join ([str(i) for i in nodes]))
+        # optional sample rate and link counter bin width (ns) read after the ids by the patched simulator
+        if 'counter-interval' in trace:
+          tracefile.write ('\n%d %d' % (int (trace.get ('sample', 1)), int (trace['counter-interval'])))
+        elif trace.get ('sample', 1) > 1:
+          tracefile.write ('\n%d' % (int (trace['sample'])))
 
     if ns3['opt']['flow-file']:
       # copy flow file
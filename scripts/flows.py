@@ -0,0 +1,242 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import matplotlib.pyplot as plt
+import numpy as np
+import os
+import pandas as pd
+import sys
+
+from packetstore import is_store, open_store, store_chunks, store_sample
+
+# flows rebuilt from parsed packets and joined with the fct-output-file of the simulator
+# a flow is a run of packets from src to dst received at dst without a gap longer than --gap
+
+FCT = ['sip', 'dip', 'sport', 'dport', 'size', 'start', 'fct', 'standalone']
+
+def read_packet_chunks (filename, chunk_size = None):
+  # timestamp,node,src,dst,size in time order, chunked csv files need ns3.py -s
+  keys = ['timestamp', 'node', 'src', 'dst', 'size']
+  if is_store (filename):
+    for chunk in store_chunks (open_store (filename), keys, chunk_size = chunk_size):
+      yield chunk
+    return
+  if chunk_size is None:
+    chunks = [pd.read_csv (filename, float_precision = 'round_trip', usecols = keys)]
+  else:
+    chunks = pd.read_csv (filename, float_precision = 'round_trip', usecols = keys, chunksize = chunk_size)
+  last = -np.inf
+  for chunk in chunks:
+    timestamp = chunk['timestamp'].to_numpy ()
+    # flows are finalized per chunk, out of order packets would split them
+    if chunk_size is not None and len (timestamp) > 0:
+      if timestamp[0] < last or np.any (np.diff (timestamp) < 0):
+        print ('%s is not sorted by timestamp, write it with ns3.py -s or drop --chunk-size' % (filename))
+        sys.exit (1)
+      last = timestamp[-1]
+    yield {key: chunk[key].to_numpy () for key in keys}
+
+def group_flows (key, start, end, nbytes, packets, gap):
+  # runs of one key with gaps of at most gap, rows of one key must not overlap
+  order = np.lexsort ((start, key))
+  key, start, end, nbytes, packets = key[order], start[order], end[order], nbytes[order], packets[order]
+  if len (key) == 0:
+    return {'key': key, 'start': start, 'end': end, 'bytes': nbytes, 'packets': packets}
+  # group boundaries on the sorted columns, a new key or a silence longer than gap
+  first = np.flatnonzero (np.concatenate (([True], (key[1:] != key[:-1]) | (start[1:] - end[:-1] > gap))))
+  return {
+    'key': key[first],
+    'start': start[first],
+    'end': np.maximum.reduceat (end, first),
+    'bytes': np.add.reduceat (nbytes, first),
+    'packets': np.add.reduceat (packets, first)
+  }
+
+def reconstruct_flows (chunks, gap, sample = 1):
+  # chunks in time order, a flow that ended more than gap before the newest packet is final
+  # so only the last flow of every (src, dst) is carried between chunks
+  current = {
+    'key': np.zeros (0, dtype = np.int64),
+    'start': np.zeros (0, dtype = np.float64),
+    'end': np.zeros (0, dtype = np.float64),
+    'bytes': np.zeros (0, dtype = np.float64),
+    'packets': np.zeros (0, dtype = np.int64)
+  }
+  final = []
+  npackets = 0
+  for chunk in chunks:
+    # every hop receives the packet, count it once at its destination
+    arrived = chunk['node'] == chunk['dst']
+    timestamp = chunk['timestamp'][arrived].astype (np.float64)
+    if len (timestamp) == 0:
+      continue
+    npackets = npackets + len (timestamp)
+    key = chunk['src'][arrived].astype (np.int64) << 32 | chunk['dst'][arrived].astype (np.int64)
+    flows = group_flows (
+      np.concatenate ((current['key'], key)),
+      np.concatenate ((current['start'], timestamp)),
+      np.concatenate ((current['end'], timestamp)),
+      np.concatenate ((current['bytes'], chunk['size'][arrived].astype (np.float64))),
+      np.concatenate ((current['packets'], np.ones (len (timestamp), dtype = np.int64))),
+      gap)
+    done = flows['end'] < timestamp.max () - gap
+    final.append ({name: column[done] for name, column in flows.items ()})
+    current = {name: column[~done] for name, column in flows.items ()}
+  final.append (current)
+  flows = {name: np.concatenate ([f[name] for f in final]) for name in current}
+  order = np.lexsort ((flows['start'], flows['key']))
+  flows = {name: column[order] for name, column in flows.items ()}
+  duration = flows['end'] - flows['start']
+  # sampled traces only saw 1 in sample packets
+  nbytes = flows['bytes'] * sample
+  df = pd.DataFrame ({
+    'src': flows['key'] >> 32,
+    'dst': flows['key'] & 0xffffffff,
+    'start': flows['start'],
+    'end': flows['end'],
+    'duration': duration,
+    'bytes': nbytes,
+    'packets': flows['packets'] * sample,
+    # receive span of the flow, a single packet flow has none
+    'throughput': np.divide (nbytes * 8.0, duration, out = np.full (len (duration), np.nan), where = duration > 0)
+  })
+  return df, npackets
+
+def read_fct (filename):
+  # sip dip sport dport size (B) start (ns) fct (ns) standalone fct (ns), one line per finished queue pair
+  if os.path.getsize (filename) == 0:
+    fct = pd.DataFrame ({name: pd.Series (dtype = str if name in ['sip', 'dip'] else np.int64) for name in FCT})
+  else:
+    fct = pd.read_csv (filename, sep = r'\s+', header = None, names = FCT, dtype = {'sip': str, 'dip': str})
+  # node ips are 0x0b000001 + (id / 256) * 0x10000 + (id % 256) * 0x100
+  src = fct['sip'].map (lambda ip: int (ip, 16)).to_numpy (dtype = np.int64)
+  dst = fct['dip'].map (lambda ip: int (ip, 16)).to_numpy (dtype = np.int64)
+  start = fct['start'].to_numpy (dtype = np.float64) * 1e-9
+  duration = fct['fct'].to_numpy (dtype = np.float64) * 1e-9
+  standalone = fct['standalone'].to_numpy (dtype = np.float64) * 1e-9
+  return pd.DataFrame ({
+    'src': (src >> 8) & 0xffff,
+    'dst': (dst >> 8) & 0xffff,
+    'sport': fct['sport'].to_numpy (dtype = np.int64),
+    'dport': fct['dport'].to_numpy (dtype = np.int64),
+    'size': fct['size'].to_numpy (dtype = np.int64),
+    'start': start,
+    'end': start + duration,
+    'fct': duration,
+    'standalone': standalone,
+    'slowdown': np.divide (duration, standalone, out = np.full (len (duration), np.nan), where = standalone > 0)
+  })
+
+def join_flows (fct, flows):
+  # every queue pair takes the packet flow of its (src, dst) that started last before it finished
+  # queue pairs between the same nodes at the same time share one packet flow
+  key = fct['src'].to_numpy (dtype = np.int64) << 32 | fct['dst'].to_numpy (dtype = np.int64)
+  left = fct.assign (key = key, row = np.arange (len (fct))).sort_values ('end')
+  right = pd.DataFrame ({
+    'key': flows['src'].to_numpy (dtype = np.int64) << 32 | flows['dst'].to_numpy (dtype = np.int64),
+    'flow-start': flows['start'],
+    'flow-end': flows['end'],
+    'flow': np.arange (len (flows))
+  }).sort_values ('flow-start')
+  joined = pd.merge_asof (left, right, left_on = 'end', right_on = 'flow-start', by = 'key', direction = 'backward')
+  # the flow has to reach into the lifetime of the queue pair
+  match = joined['flow-end'].to_numpy () >= joined['start'].to_numpy ()
+  flow = np.where (match, joined['flow'].fillna (-1).to_numpy (), -1).astype (np.int64)
+  out = fct.copy ()
+  out['flow'] = -1
+  out.loc[joined['row'].to_numpy (), 'flow'] = flow
+  throughput = flows['throughput'].to_numpy ()
+  out['throughput'] = np.where (out['flow'] >= 0, throughput[np.maximum (out['flow'].to_numpy (), 0)], np.nan)
+  return out
+
+def distribution (values, percentiles):
+  # count, mean, max and tail percentiles of the finite values
+  values = np.asarray (values, dtype = np.float64)
+  values = values[np.isfinite (values)]
+  if len (values) == 0:
+    return {'count': 0}
+  out = {'count': int (len (values)), 'mean': float (np.mean (values)), 'max': float (np.max (values))}
+  for q, value in zip (percentiles, np.percentile (values, percentiles)):
+    out['p%g' % (q)] = float (value)
+  return out
+
+def plot_cdf (ax, values, label):
+  values = np.asarray (values, dtype = np.float64)
+  values = np.sort (values[np.isfinite (values)])
+  ax.step (values, np.arange (1, len (values) + 1) / max (len (values), 1), where = 'post', label = label)
+
+def main ():
+  parser = argparse.ArgumentParser(
+    prog='ASTRA-ns3-Flow-Analysis',
+    description='',
+    epilog='')
+  parser.add_argument('-l', '--link', required = True)
+  parser.add_argument('-f', '--fct', default = None)
+  parser.add_argument('-g', '--gap', type = float, default = 1e-5) # silence (s) that ends a flow
+  parser.add_argument('--chunk-size', type = int, default = None)
+  parser.add_argument('--percentiles', type = float, nargs = '+', default = [50, 90, 99, 99.9])
+  parser.add_argument('--report', default = 'flows.json')
+  parser.add_argument('--no-plot', action = 'store_true', default = False)
+  args = parser.parse_args (sys.argv[1:])
+
+  sample = store_sample (args.link) if is_store (args.link) else 1
+  flows, npackets = reconstruct_flows (read_packet_chunks (args.link, args.chunk_size), args.gap, sample)
+  if npackets == 0:
+    print ('no packets received at their destination, the compute nodes have to be traced')
+    sys.exit (1)
+  print ('Reconstructed (%d) flows from (%d) packets' % (len (flows), npackets))
+  flows.to_csv ('flows.csv', index = False)
+
+  report = {
+    'gap': args.gap,
+    'sample': sample,
+    'flows': {
+      'count': len (flows),
+      'bytes': distribution (flows['bytes'], args.percentiles),
+      'duration': distribution (flows['duration'], args.percentiles),
+      'throughput': distribution (flows['throughput'], args.percentiles)
+    }
+  }
+  fct = None
+  if args.fct:
+    fct = join_flows (read_fct (args.fct), flows)
+    fct.to_csv ('fct.csv', index = False)
+    print ('Matched (%d) of (%d) queue pairs to packet flows' % (np.sum (fct['flow'] >= 0), len (fct)))
+    report['fct'] = {
+      'count': len (fct),
+      'matched': int (np.sum (fct['flow'] >= 0)),
+      'fct': distribution (fct['fct'], args.percentiles),
+      'slowdown': distribution (fct['slowdown'], args.percentiles),
+      'throughput': distribution (fct['throughput'], args.percentiles)
+    }
+    for name, label in [('fct', 'FCT (s)'), ('slowdown', 'Slowdown')]:
+      stats = report['fct'][name]
+      if stats['count'] > 0:
+        print ('%s ' % (label) + ', '.join (['p%g (%g)' % (q, stats['p%g' % (q)]) for q in args.percentiles]))
+
+  if not args.no_plot:
+    fig, ax = plt.subplots ()
+    plot_cdf (ax, flows['throughput'] * 1e-9, 'flows')
+    ax.set_xlabel ('Throughput (Gbps)')
+    ax.set_ylabel ('CDF')
+    ax.set_title ('Per Flow Throughput')
+    plt.savefig ('throughput.png')
+    if fct is not None:
+      fig, (ax0, ax1) = plt.subplots (1, 2, figsize = (10, 4))
+      plot_cdf (ax0, fct['fct'], 'fct')
+      ax0.set_xscale ('log')
+      ax0.set_xlabel ('Flow Completion Time (s)')
+      ax0.set_ylabel ('CDF')
+      plot_cdf (ax1, fct['slowdown'], 'slowdown')
+      ax1.set_xscale ('log')
+      ax1.set_xlabel ('Slowdown')
+      fig.suptitle ('Flow Completion')
+      plt.savefig ('fct.png')
+
+  # machine readable summary for sweeps
+  with open (args.report, 'w') as file:
+    json.dump (report, file, indent = 2)
+
+if __name__ == '__main__':
+  main ()
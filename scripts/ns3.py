@@ -1,63 +1,297 @@
 #!/usr/bin/python3
 
 import argparse
+import json
 import numpy as np
 import os
 import pandas as pd
 import re
 import sys
+import tempfile
+import time
 
-def parse_packets (packets):
-  data = {
-    'timestamps': [],
-    'sizes': [],
-    'srcs': [],
-    'dsts': []
+from multiprocessing import Pool
+
+from linktable import read_link_table, resolve_links
+from packetstore import append_store, merge_runs, truncate_store, write_blocks
+
+# receive events only, fields pulled from the ipv4 header
+# the literal newline prefix lets the scanner jump between event lines
+# node n has address 11.<n / 256>.<n % 256>.1
+PACKET = re.compile (
+  rb'\nr (?P<timestamp>[0-9.e+-]+) ns3::PppHeader \([^)]*\)\) ' +
+  rb'ns3::Ipv4Header \(tos \S+ DSCP \S+ ECN \S+ ttl [0-9]+ id [0-9]+ protocol [0-9]+ ' +
+  rb'offset \(bytes\) [0-9]+ flags \[[^\]]*\] length: (?P<size>[0-9]+) ' +
+  rb'11\.(?P<srchi>[0-9]+)\.(?P<src>[0-9]+)\.1 > 11\.(?P<dsthi>[0-9]+)\.(?P<dst>[0-9]+)\.1')
+
+# binary receive trace written by the patched qbb device when enable-trace is 2
+# 1 in sample received packets of every device is recorded
+RECEIVE_HEADER = np.dtype ([
+  ('magic', 'S8'),
+  ('version', '<u4'),
+  ('record', '<u4'),
+  ('sample', '<u4'),
+  ('reserved', '<u4')
+])
+
+RECEIVE = np.dtype ([
+  ('timestamp', '<f8'),
+  ('node', '<u4'),
+  ('src', '<u4'),
+  ('dst', '<u4'),
+  ('size', '<u4'),
+  ('link', '<u2'),
+  ('reserved', '<u2'),
+  ('padding', '<u4')
+])
+
+def open_receive_trace (filename):
+  # memory mapped records and sample rate, a record cut short by a running simulation is left out
+  header = np.fromfile (filename, dtype = RECEIVE_HEADER, count = 1)
+  if len (header) == 0 or header[0]['magic'] != b'ASTRARX' or header[0]['version'] != 2:
+    print ('(%s) is not a binary receive trace' % (filename))
+    sys.exit (1)
+  if header[0]['record'] != RECEIVE.itemsize:
+    print ('unsupported record size (%d)' % (header[0]['record']))
+    sys.exit (1)
+  offset, sample = RECEIVE_HEADER.itemsize, max (1, int (header[0]['sample']))
+  count = max (0, os.path.getsize (filename) - offset) // RECEIVE.itemsize
+  if count == 0:
+    return np.zeros (0, dtype = RECEIVE), sample
+  return np.memmap (filename, dtype = RECEIVE, mode = 'r', offset = offset, shape = (count,)), sample
+
+def fields (table = None):
+  # output columns, link-id,tier only when a topology was given
+  return ['timestamp', 'node', 'link', 'src', 'dst', 'size'] + ([] if table is None else ['link-id', 'tier'])
+
+def resolve_columns (columns, table = None):
+  # global link id in topology order and its tier, one table lookup for the whole column
+  if table is not None:
+    columns['link-id'] = resolve_links (table, columns['node'], columns['link'])
+    columns['tier'] = table['tier'][columns['link-id']]
+  return columns
+
+def receive_columns (records):
+  # timestamp,node,link,src,dst,size with links 0 indexed like the ascii path
+  return {
+    'timestamp': np.asarray (records['timestamp'], dtype = np.float64),
+    'node': np.asarray (records['node'], dtype = np.int64),
+    'link': np.asarray (records['link'], dtype = np.int64) - 1,
+    'src': np.asarray (records['src'], dtype = np.int64),
+    'dst': np.asarray (records['dst'], dtype = np.int64),
+    'size': np.asarray (records['size'], dtype = np.int64)
   }
-  for packet in packets:
-    parsed_packet = parse_packet (packet)
-    data['timestamps'].append (parsed_packet['timestamp'])
-    data['sizes'].append (parsed_packet['size'])
-    data['srcs'].append (parsed_packet['src'])
-    data['dsts'].append (parsed_packet['dst'])
-  return data
-
-def parse_packet (packet):
-  # pull out ipv4 header
-  pattern = r'r' + r'\s*' + \
-            r'(?P<timestamp>[0-9]+(\.[0-9]+)?(e-[0-9]+)?)' + r'\s*' + \
-            r'ns3::PppHeader' + r'\s*' + r'\((?P<ppp>.*)\)' + r'\s*' + \
-            r'ns3::Ipv4Header' + r'\s*' + r'\((?P<ip>.*)\)' + r'\s+' + 'ns3::((qbbHeader)|(UdpHeader))'
-  m = re.match (pattern, packet)
-  timestamp = float (m.group ('timestamp'))
-  ipconfig = m.group ('ip')
-
-  # parse ipv4 header
-  pattern = r'tos\s*0x\w+\s*DSCP\s*Default\s*ECN\s*((Not-ECT)|(CE))\s*' + \
-            r'ttl\s*[0-9]+\s*' + \
-            r'id\s*[0-9]+\s*' + \
-            r'protocol\s*[0-9]+\s*' + \
-            r'offset\s*\(bytes\)\s*[0-9]+\s*' + \
-            r'flags\s*\[[\w\s]+\]\s*' + \
-            r'length:\s*(?P<size>[0-9]+)\s*' + \
-            r'11\.0\.(?P<src>[0-9]+)\.1\s*>\s*' + \
-            r'11\.0\.(?P<dst>[0-9]+)\.1'
-  try:
-    m = re.match (pattern, ipconfig)
-    size = int (m.group ('size'))
-    src = int (m.group ('src'))
-    dst = int (m.group ('dst'))
-  except:
-    print (ipconfig)
-    sys.exit ()
-  
+
+def convert_receive_trace (filename, output, format = 'csv', flush = 1 << 20, table = None):
+  records, sample = open_receive_trace (filename)
+  print ('\tContained (%d) packet events' % (len (records)))
+  if format == 'bin':
+    # the simulator writes receive events in time order, stream them straight into the store
+    blocks = (resolve_columns (receive_columns (records[begin:begin + flush]), table) for begin in range (0, len (records), flush))
+    write_blocks (output, blocks, len (records), sample, table is not None)
+    return
+  if sample > 1:
+    # csv has no header to carry it, power.py needs --sample
+    print ('\tSampled 1 in (%d) packets, pass --sample %d to power.py' % (sample, sample))
+  # csv rows are written in bounded runs
+  for begin in range (0, len (records), flush):
+    pd.DataFrame (resolve_columns (receive_columns (records[begin:begin + flush]), table)).to_csv (output, mode = 'a', header = False, index = False)
+
+def parse_packets (trace):
+  # single scan over the raw trace bytes, other events never match
+  trace = b'\n' + trace
+  fields = PACKET.findall (trace)
+  # receive events that did not match are malformed
+  events = trace.count (b'\nr ')
+  if events != len (fields):
+    print ('\tSkipped (%d) malformed packet events' % (events - len (fields)))
+  columns = np.array (fields, dtype = bytes).reshape (-1, 6)
   return {
-    'timestamp': timestamp,
-    'size': size,
-    'src': src,
-    'dst': dst
+    'timestamps': columns[:, 0].astype (np.float64),
+    'sizes': columns[:, 1].astype (np.int64),
+    'srcs': columns[:, 2].astype (np.int64) * 256 + columns[:, 3].astype (np.int64),
+    'dsts': columns[:, 4].astype (np.int64) * 256 + columns[:, 5].astype (np.int64)
   }
 
+def read_chunks (tr, block_size):
+  # whole lines in blocks of about block_size bytes, a partial last line is carried over
+  rest = b''
+  while True:
+    block = tr.read (block_size)
+    if not block:
+      break
+    block = rest + block
+    cut = block.rfind (b'\n') + 1
+    rest = block[cut:]
+    if cut > 0:
+      yield block[:cut]
+  if rest:
+    yield rest
+
+# one raw file per column and trace, a device trace is in time order so every shard is a sorted run
+SHARD = [
+  ('timestamp', np.float64),
+  ('node', np.int64),
+  ('link', np.int64),
+  ('src', np.int64),
+  ('dst', np.int64),
+  ('size', np.int64)
+]
+
+def shard_column (scratch, index, name):
+  return os.path.join (scratch, '%d.%s' % (index, name))
+
+def write_part (scratch, index, buffered, node, link):
+  # one flushed run of records appended to the shard, columns concatenated only here
+  timestamps = np.concatenate ([data['timestamps'] for data in buffered])
+  nsamples = len (timestamps)
+  columns = {
+    'timestamp': timestamps,
+    'node': np.full (nsamples, node, dtype = np.int64),
+    'link': np.full (nsamples, link, dtype = np.int64),
+    'src': np.concatenate ([data['srcs'] for data in buffered]),
+    'dst': np.concatenate ([data['dsts'] for data in buffered]),
+    'size': np.concatenate ([data['sizes'] for data in buffered])
+  }
+  for name, dtype in SHARD:
+    with open (shard_column (scratch, index, name), 'ab') as file:
+      file.write (columns[name].astype (dtype).tobytes ())
+
+def parse_trace (task):
+  # stream one trace file into a columnar shard, runs in worker processes
+  index, filename, node, link, scratch, block_size, flush = task
+  nsamples = 0
+  buffered = []
+  nbuffered = 0
+  with open (filename, 'rb') as tr:
+    for block in read_chunks (tr, block_size):
+      data = parse_packets (block)
+      buffered.append (data)
+      nbuffered = nbuffered + len (data['timestamps'])
+      # bounded memory, flush every flush records
+      if nbuffered >= flush:
+        write_part (scratch, index, buffered, node, link)
+        nsamples = nsamples + nbuffered
+        buffered = []
+        nbuffered = 0
+  if nbuffered > 0:
+    write_part (scratch, index, buffered, node, link)
+    nsamples = nsamples + nbuffered
+  return index, filename, nsamples
+
+def open_shard (scratch, index, nsamples):
+  # memory mapped columns of one shard, timestamp,node,link,src,dst,size
+  if nsamples == 0:
+    return {name: np.zeros (0, dtype = dtype) for name, dtype in SHARD}
+  return {name: np.memmap (shard_column (scratch, index, name), dtype = dtype, mode = 'r', shape = (nsamples,)) for name, dtype in SHARD}
+
+def merge_store (shards, output, table = None, block = 1 << 20):
+  # k-way merge of the shards written through the mapped store, about block records in memory
+  count = sum ([len (shard['timestamp']) for shard in shards])
+  chunks = merge_runs (shards, max (1, block // max (1, len (shards))))
+  write_blocks (output, (resolve_columns (chunk, table) for chunk in chunks), count, 1, table is not None)
+
+def merge_shards (shards, output, sort = False, table = None, block = 1 << 20):
+  # shards are appended in trace order a block at a time, or interleaved by timestamp
+  if not sort:
+    for shard in shards:
+      for begin in range (0, len (shard['timestamp']), block):
+        columns = {name: np.asarray (column[begin:begin + block]) for name, column in shard.items ()}
+        pd.DataFrame (resolve_columns (columns, table)).to_csv (output, mode = 'a', header = False, index = False)
+    return
+  for chunk in merge_runs (shards, max (1, block // max (1, len (shards)))):
+    pd.DataFrame (resolve_columns (chunk, table)).to_csv (output, mode = 'a', header = False, index = False)
+
+def load_checkpoint (filename):
+  try:
+    with open (filename, 'r') as file:
+      return json.load (file)
+  except FileNotFoundError:
+    return None
+
+def save_checkpoint (filename, checkpoint):
+  # replaced in one step so a crash leaves the previous checkpoint
+  with open (filename + '.tmp', 'w') as file:
+    json.dump (checkpoint, file)
+  os.replace (filename + '.tmp', filename)
+
+def flush_output (args, checkpoint, buffered):
+  # append the buffered columns, then checkpoint the offsets they were parsed up to
+  # returns the number of records written
+  count = sum ([len (b['timestamp']) for b in buffered])
+  if count > 0:
+    columns = {key: np.concatenate ([b[key] for b in buffered]) for key in buffered[0]}
+    if args.format == 'bin':
+      checkpoint['output'] = append_store (args.output, columns)
+    else:
+      pd.DataFrame (columns).to_csv (args.output, mode = 'a', header = False, index = False)
+      checkpoint['output'] = os.path.getsize (args.output)
+  save_checkpoint (args.checkpoint, checkpoint)
+  return count
+
+def follow (args, pattern, table = None):
+  # parse only complete lines appended since the last poll, resuming from the checkpoint
+  # output is the committed length of the output, bytes of a csv file or records of a store
+  checkpoint = load_checkpoint (args.checkpoint)
+  if checkpoint is None:
+    checkpoint = {'output': 0, 'files': {}}
+    if args.format == 'csv':
+      with open (args.output, 'w') as csv:
+        csv.write (','.join (fields (table)) + '\n')
+      checkpoint['output'] = os.path.getsize (args.output)
+    elif os.path.exists (args.output):
+      os.remove (args.output)
+    save_checkpoint (args.checkpoint, checkpoint)
+  elif args.format == 'csv':
+    # drop rows written after the last checkpoint, they are parsed again
+    with open (args.output, 'r+') as csv:
+      csv.truncate (checkpoint['output'])
+  elif os.path.exists (args.output):
+    truncate_store (args.output, checkpoint['output'])
+  last = time.time ()
+  while True:
+    # parsed columns not yet written, at most about --flush records
+    buffered = []
+    pending = 0
+    appended = 0
+    for t in sorted (os.listdir (args.location)):
+      m = re.match (pattern, t)
+      if not m:
+        continue
+      filename = os.path.join (args.location, t)
+      offset = checkpoint['files'].get (t, 0)
+      with open (filename, 'rb') as tr:
+        tr.seek (offset)
+        for block in read_chunks (tr, args.block_size):
+          # a line still being written is left for the next poll
+          if not block.endswith (b'\n'):
+            break
+          data = parse_packets (block)
+          offset = offset + len (block)
+          nsamples = len (data['timestamps'])
+          buffered.append (resolve_columns ({
+            'timestamp': data['timestamps'],
+            'node': np.full (nsamples, int (m.group ('node')), dtype = np.int64),
+            # links are 1 indexed lets change that
+            'link': np.full (nsamples, int (m.group ('link')) - 1, dtype = np.int64),
+            'src': data['srcs'],
+            'dst': data['dsts'],
+            'size': data['sizes']
+          }, table))
+          checkpoint['files'][t] = offset
+          pending = pending + nsamples
+          if pending >= args.flush:
+            appended = appended + flush_output (args, checkpoint, buffered)
+            buffered = []
+            pending = 0
+    appended = appended + flush_output (args, checkpoint, buffered)
+    if appended > 0:
+      print ('Appended (%d) packet events' % (appended))
+      last = time.time ()
+    # stop once the traces stop growing
+    if args.idle is not None and time.time () - last >= args.idle:
+      break
+    time.sleep (args.interval)
 
 def main ():
   parser = argparse.ArgumentParser(
@@ -68,34 +302,70 @@ def main ():
   parser.add_argument('-p', '--prefix', required = True)
   parser.add_argument('-o', '--output', default = 'packet-parser-out.csv')
   parser.add_argument('-a', '--append', action = 'store_true', default = False)
+  parser.add_argument('-j', '--jobs', type = int, default = 1)
+  parser.add_argument('-s', '--sort', action = 'store_true', default = False)
+  parser.add_argument('--block-size', type = int, default = 1 << 24)
+  parser.add_argument('--flush', type = int, default = 1 << 20)
+  parser.add_argument('-f', '--format', choices = ['csv', 'bin'], default = 'csv')
+  parser.add_argument('--follow', action = 'store_true', default = False)
+  parser.add_argument('--interval', type = float, default = 5.0)
+  parser.add_argument('--idle', type = float, default = None)
+  parser.add_argument('--checkpoint', default = None)
+  parser.add_argument('-b', '--binary', action = 'store_true', default = False)
+  parser.add_argument('-t', '--topology', default = None)
   args = parser.parse_args (sys.argv[1:])
 
+  # records get the link id and tier of the topology file the simulation ran with
+  table = read_link_table (args.topology) if args.topology else None
+  pattern = args.prefix + r'-(?P<node>[0-9]+)-(?P<link>[0-9]+).tr'
+  if args.follow:
+    args.checkpoint = args.checkpoint or args.output + '.offsets'
+    follow (args, pattern, table)
+    return
+
+  if args.format == 'bin' and args.append:
+    print ('cannot append to a binary packet store')
+    sys.exit (1)
   # write output header
-  access = 'a' if args.append else 'w'
-  with open (args.output, access) as csv:
-    # timestamp,node,link,src,dst,size
-    csv.write ('timestamp,node,link,src,dst,size\n')
+  if args.format == 'csv':
+    access = 'a' if args.append else 'w'
+    with open (args.output, access) as csv:
+      csv.write (','.join (fields (table)) + '\n')
+
+  if args.binary:
+    # single <prefix>.bin written by the simulator, no text to parse
+    filename = os.path.join (args.location, args.prefix + '.bin')
+    print ('Reading (%s)...' % filename)
+    convert_receive_trace (filename, args.output, args.format, args.flush, table)
+    return
 
-  pattern = args.prefix + r'-(?P<node>[0-9]+)-(?P<link>[0-9]+).tr'
   traces = [{'name': t, 'regex': re.match (pattern, t)} for t in os.listdir (args.location) if re.match (pattern, t)]
-  for trace in traces:
-    filename = os.path.join (args.location, trace['name'])
-    print ('Parsing (%s)...' % filename)
-    with open (filename) as tr:
-      packets = tr.read ().splitlines ()
-      data = parse_packets (packets)
-      # parse into csv
-      nsamples = len (data['timestamps'])
-      print ('\tContained (%d) packet events' % (nsamples))
-      nodes = [trace['regex'].group('node') for _ in range (nsamples)]
+  # every trace is parsed into its own shard then merged in trace order
+  with tempfile.TemporaryDirectory (dir = os.path.dirname (os.path.abspath (args.output))) as scratch:
+    tasks = []
+    for i, trace in enumerate (traces):
+      filename = os.path.join (args.location, trace['name'])
+      node = int (trace['regex'].group ('node'))
       # links are 1 indexed lets change that
-      links = [int (trace['regex'].group('link')) - 1 for _ in range (nsamples)]
-      # timestamp,node,link,src,dst,size
-      rows = zip (data['timestamps'],nodes,links,data['srcs'],data['dsts'],data['sizes'])
-      with open (args.output, 'a') as csv:
-        for row in rows:
-          r = [str (item) for item in row]
-          csv.write (','.join (r) + '\n')
+      link = int (trace['regex'].group ('link')) - 1
+      tasks.append ((i, filename, node, link, scratch, args.block_size, args.flush))
+    # largest files first so no worker is left with a big one at the end
+    tasks.sort (key = lambda task: -os.path.getsize (task[1]))
+    pool = Pool (args.jobs) if args.jobs > 1 else None
+    results = pool.imap_unordered (parse_trace, tasks) if pool is not None else map (parse_trace, tasks)
+    counts = [0 for _ in traces]
+    for i, filename, nsamples in results:
+      print ('Parsed (%s)...' % filename)
+      print ('\tContained (%d) packet events' % (nsamples))
+      counts[i] = nsamples
+    if pool is not None:
+      pool.close ()
+      pool.join ()
+    shards = [open_shard (scratch, i, counts[i]) for i in range (len (traces))]
+    if args.format == 'bin':
+      merge_store (shards, args.output, table, args.flush)
+    else:
+      merge_shards (shards, args.output, args.sort, table, args.flush)
 
 if __name__ == '__main__':
   main ()
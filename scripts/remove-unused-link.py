@@ -14,11 +14,15 @@ try:
 except ImportError:
   from yaml import Loader, Dumper
 
+from linkcounters import counter_columns, is_counters, open_counters
+from packetstore import is_store, open_store, store_sample
+
 def parse (topology_filename):
   # read design
   links = {
     'srcdst': {},
-    'nodelink': {}
+    'nodelink': {},
+    'order': []
   }
   nodes = {}
   with open (topology_filename, 'r') as topology:
@@ -41,9 +45,37 @@ def parse (topology_filename):
       links['srcdst'][(a, b)] = 0
       links['nodelink'][(a, linka)] = (a, b)
       links['nodelink'][(b, linkb)] = (a, b)
+      links['order'].append ((a, b))
   return links
 
 def usage (packet_filename, links):
+  if is_counters (packet_filename):
+    # packets per interface summed over the time bins
+    _, records = open_counters (packet_filename)
+    counters = counter_columns (records)
+    for node, link, count in zip (counters['node'], counters['link'], counters['packets']):
+      a, b = links['nodelink'][(int (node), int (link))]
+      links['srcdst'][(a, b)] = links['srcdst'][(a, b)] + int (count)
+    return links
+  if is_store (packet_filename):
+    # per link index already holds the packet count of every interface
+    # sampled stores are scaled back up, the first packet of every interface is always traced
+    store = open_store (packet_filename)
+    counts = np.asarray (store['counts']) * store_sample (packet_filename)
+    keys = np.asarray (store['keys'])
+    for node, link, count in zip (keys >> np.uint64 (16), keys & np.uint64 (0xffff), counts):
+      a, b = links['nodelink'][(int (node), int (link))]
+      links['srcdst'][(a, b)] = links['srcdst'][(a, b)] + int (count)
+    return links
+  with open (packet_filename, 'r') as packets:
+    header = packets.readline ().strip ().split (',')
+  if 'link-id' in header:
+    # ns3.py resolved the links in topology order, count per link id directly
+    ids = pd.read_csv (packet_filename, usecols = ['link-id'])['link-id'].to_numpy (dtype = np.int64)
+    for i, count in enumerate (np.bincount (ids, minlength = len (links['order']))):
+      a, b = links['order'][i]
+      links['srcdst'][(a, b)] = links['srcdst'][(a, b)] + int (count)
+    return links
   with open (packet_filename, 'r') as packets:
     # expects file with parsed packet syntax used in parse-ns3-packets
     lines = packets.read ().splitlines ()[1:] # skip header
@@ -97,6 +97,7 @@ def generate (topology, filename, target_design, verbose = False, k = 2, N = 40,
     design['power'] = {}
     design['power']['link'] = []
     design['power']['compute'] = []
+    design['power']['switch'] = []
 
   # set up compute
   design['dims'][0]['npus'] = len (output['comp'])
@@ -132,6 +133,8 @@ def generate (topology, filename, target_design, verbose = False, k = 2, N = 40,
           'idle': link.idle (),
           'peak': link.peak ()
         }
+        if link.epb () > 0:
+          lg['energy-per-bit'] = link.epb ()
         linkpowers[type (link)] = len (design['power']['link'])
         design['power']['link'].append (lg)
       # append to node list
@@ -141,6 +144,20 @@ def generate (topology, filename, target_design, verbose = False, k = 2, N = 40,
       }
       design['power']['link'][linkpowers[type (link)]]['links'].append (linkdesc)
 
+  # one switch power group per switch type
+  if 'switch' not in design['power'].keys ():
+    design['power']['switch'] = []
+  switchpowers = {}
+  for switch in output['switch']:
+    if type (switch) not in switchpowers:
+      switchpowers[type (switch)] = len (design['power']['switch'])
+      design['power']['switch'].append ({
+        'switches': [],
+        'idle': switch.idle (),
+        'peak': switch.peak ()
+      })
+    design['power']['switch'][switchpowers[type (switch)]]['switches'].append (map[switch.id ()])
+
   # dump out contents
   with open (filename, 'w') as file:
     yaml.dump (yml, file, default_flow_style = False)
@@ -153,8 +153,24 @@ class Animation ():
     if filename is not None:
       with open (filename) as ffile:
         lines = ffile.read ().splitlines ()
-        active = [line.split (',') for line in lines]
-        frames.extend (active)
+        if len (lines) > 0 and lines[0] == 'frame,entity,active':
+          # run-length encoded change events, replay them frame by frame
+          events = [line.split (',') for line in lines[1:]]
+          nframes = int (events[-1][0]) if len (events) > 0 else 0
+          active = set ()
+          j = 0
+          for i in range (nframes):
+            while j < len (events) and int (events[j][0]) <= i:
+              if events[j][1] != '':
+                if events[j][2] == '1':
+                  active.add (events[j][1])
+                else:
+                  active.discard (events[j][1])
+              j = j + 1
+            frames.append (list (active))
+        else:
+          active = [line.split (',') for line in lines]
+          frames.extend (active)
     this.frames = frames
 
     # save first frame